@@ -36,6 +36,7 @@ NODE_CLASS_MAPPINGS = {
     "Sage_LoraStack": Sage_LoraStack,
     "Sage_LoraStackRecent": Sage_LoraStackRecent,
     "Sage_LoraStackLoader": Sage_LoraStackLoader,
+    "Sage_LoraStackLoaderFused": Sage_LoraStackLoaderFused,
     "Sage_DualCLIPTextEncode": Sage_DualCLIPTextEncode,
     "Sage_SamplerInfo": Sage_SamplerInfo,
     "Sage_AdvSamplerInfo": Sage_AdvSamplerInfo,
@@ -47,6 +48,7 @@ NODE_CLASS_MAPPINGS = {
     "Sage_PopulateCache": Sage_PopulateCache,
     "Sage_CacheMaintenance": Sage_CacheMaintenance,
     "Sage_ModelReport": Sage_ModelReport,
+    "Sage_ModelHeaderInfo": Sage_ModelHeaderInfo,
     "Sage_ModelInfoFromModelId": Sage_ModelInfoFromModelId
 }
 
@@ -74,6 +76,7 @@ NODE_DISPLAY_NAME_MAPPINGS  = {
     "Sage_LoraStack": "Simple Lora Stack",
     "Sage_LoraStackRecent": "Recent Lora Stack",
     "Sage_LoraStackLoader": "Lora Stack Loader",
+    "Sage_LoraStackLoaderFused": "Lora Stack Loader (Merged)",
     "Sage_DualCLIPTextEncode": "Prompts to CLIP",
     "Sage_SamplerInfo": "Sampler Info",
     "Sage_AdvSamplerInfo": "Adv Sampler Info",
@@ -85,6 +88,7 @@ NODE_DISPLAY_NAME_MAPPINGS  = {
     "Sage_PopulateCache": "Scan for Metadata & Hash",
     "Sage_CacheMaintenance": "Cache Maintenance",
     "Sage_ModelReport": "Model Report",
+    "Sage_ModelHeaderInfo": "Model Info from Safetensors Header",
     "Sage_ModelInfoFromModelId": "Get Model Info from Model Id"
 }
 
@@ -1,9 +1,14 @@
 # A collection of utility nodes, many of which are dealing with metadata and collecting it.
 import os
 import json
+import hashlib
 import pathlib
 import numpy as np
 import torch
+import queue
+import threading
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 
 from PIL import Image, ImageOps
 from PIL.PngImagePlugin import PngInfo
@@ -200,12 +205,11 @@ class Sage_ConstructMetadata:
             for lora in lora_stack:
                 lora_path = folder_paths.get_full_path_or_raise("loras", lora[0])
                 lora_name = str(pathlib.Path(lora_path).name)
-                pull_metadata(lora_path)
+                lora_hash = get_model_hash(lora_path)
                 lora_data = get_model_info(lora_path, lora[1])
                 if lora_data != {}:
                     resource_hashes.append(lora_data)
                 
-                lora_hash = cache.cache_data[lora_path]["hash"]
                 lora_hashes += [f"{lora_name}: {lora_hash}"]
         
         lora_hash_string = "Lora hashes: " + ",".join(lora_hashes)
@@ -215,7 +219,7 @@ class Sage_ConstructMetadata:
         if negative_string != "":
             metadata += f"Negative prompt: {negative_string}" + "\n"
         metadata += f"Steps: {sampler_info['steps']}, Sampler: {sampler_name}, Scheduler type: {sampler_info['scheduler']}, CFG scale: {sampler_info['cfg']}, Seed: {sampler_info['seed']}, Size: {width}x{height},"
-        metadata += f"Model: {name_from_path(model_info['path'])}, Model hash: {model_info['hash']}, Version: v1.10-RC-6-comfyui, {civitai_string}, {lora_hash_string}"
+        metadata += f"Model: {name_from_path(model_info['path'])}, Model hash: {model_info['hash'] or get_model_hash(model_info['path'])}, Version: v1.10-RC-6-comfyui, {civitai_string}, {lora_hash_string}"
         return metadata,
 
 
@@ -259,7 +263,7 @@ class Sage_ConstructMetadataLite:
             # just adding the lora and model information in the resource section.
             for lora in lora_stack:
                 lora_path = folder_paths.get_full_path_or_raise("loras", lora[0])
-                pull_metadata(lora_path)
+                get_model_hash(lora_path)
                 lora_data = get_model_info(lora_path, lora[1])
                 if lora_data != {}:
                     resource_hashes.append(lora_data)
@@ -341,6 +345,28 @@ class Sage_LoraStack:
 
 # An altered version of Save Image
 class Sage_SaveImageWithMetadata:
+    # Pillow's encoders release the GIL, so a batch can be encoded on several threads at once.
+    save_workers = min(8, os.cpu_count() or 1)
+    save_executor = ThreadPoolExecutor(max_workers=save_workers, thread_name_prefix="SageUtils save")
+
+    # With async_save, images are handed to background writers through a bounded queue. When it's full,
+    # saving blocks until there's room, so a slow disk can't pile up unbounded amounts of image data in memory.
+    save_queue = queue.Queue(maxsize=16)
+    save_writers = []
+    save_writers_lock = threading.Lock()
+    # get_save_image_path picks the counter from what's already on disk, which doesn't include queued images yet,
+    # so remember the counters handed out per folder and prefix.
+    next_counter = {}
+    counter_lock = threading.Lock()
+    # AVIF needs either a new enough Pillow or the pillow-avif-plugin.
+    Image.init()
+    file_formats = ["png", "webp (lossless)", "webp", "jpeg"] + (["avif"] if "AVIF" in Image.SAVE else [])
+    extensions = {"png": "png", "webp (lossless)": "webp", "webp": "webp", "jpeg": "jpg", "avif": "avif"}
+    pil_formats = {"png": "PNG", "webp (lossless)": "WEBP", "webp": "WEBP", "jpeg": "JPEG", "avif": "AVIF"}
+
+    # With compress_metadata, text chunks bigger than this are zlib compressed. parameters never is, so Civitai can still read it.
+    compress_threshold = 1024
+
     def __init__(self):
         self.output_dir = folder_paths.get_output_directory()
         self.type = "output"
@@ -358,7 +384,13 @@ class Sage_SaveImageWithMetadata:
             },
             "optional": {
                 "param_metadata": ("STRING",{ "defaultInput": True}),
-                "extra_metadata": ("STRING",{ "defaultInput": True})
+                "extra_metadata": ("STRING",{ "defaultInput": True}),
+                "async_save": ("BOOLEAN", {"default": False, "defaultInput": False, "tooltip": "Write the files in the background and return right away, so the next prompt can start while the images are still being saved. The previews may show as broken for a moment, until the files have been written."}),
+                "file_format": (s.file_formats, {"default": "png", "tooltip": "The format to save in. Anything but png stores the parameters in the EXIF UserComment, the way A1111 does."}),
+                "quality": ("INT", {"default": 90, "min": 1, "max": 100, "tooltip": "Quality for lossy formats. For lossless webp, how hard to try to make the file smaller."}),
+                "effort": ("INT", {"default": 4, "min": 0, "max": 6, "tooltip": "How much time to spend compressing webp and avif. Higher is slower but smaller. Not used for png or jpeg."}),
+                "compress_metadata": ("BOOLEAN", {"default": False, "defaultInput": False, "tooltip": "Store the prompt and workflow as compressed iTXt chunks in png files. The parameters are always left uncompressed. Some older tools only read uncompressed chunks."}),
+                "workflow_sidecar": ("BOOLEAN", {"default": False, "defaultInput": False, "tooltip": "Save the workflow once to output/workflows/<hash>.json and only store a reference to it in the image, instead of the whole workflow in every image. ComfyUI won't be able to load the workflow by dropping the image on it."})
             },
             "hidden": {
                 "prompt": "PROMPT", "extra_pnginfo": "EXTRA_PNGINFO"
@@ -373,37 +405,157 @@ class Sage_SaveImageWithMetadata:
     CATEGORY = "Sage Utils"
     DESCRIPTION = "Saves the input images to your ComfyUI output directory with added metadata. The param_metadata input should come from Construct Metadata, and the extra_metadata is anything you want. Both are just strings, though, with the difference being that the first has a keyword of parameters, and the second, extra, so technically you could pass in your own metadata, or even type it in in a Set Text node and hook that to this node."
 
-    def set_metadata(self, include_node_metadata, include_extra_pnginfo_metadata, param_metadata = None, extra_metadata=None, prompt=None, extra_pnginfo=None):
-        result = None
+    def save_sidecar(self, text):
+        # Identical workflows share one file, named after the hash of its contents.
+        name = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        path = pathlib.Path(self.output_dir) / "workflows" / f"{name}.json"
+        if not path.is_file():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.write_text(text, encoding="utf-8")
+            tmp_path.replace(path)
+        return f"workflows/{name}.json"
+
+    def metadata_text(self, include_node_metadata, include_extra_pnginfo_metadata, param_metadata = None, extra_metadata=None, prompt=None, extra_pnginfo=None, workflow_sidecar=False):
+        result = []
         if not cli_args.args.disable_metadata:
-            result = PngInfo()
             if param_metadata is not None:
-                result.add_text("parameters", param_metadata)
+                result.append(("parameters", param_metadata))
             if include_node_metadata == True:
                 if prompt is not None:
-                    result.add_text("prompt", json.dumps(prompt))
+                    result.append(("prompt", json.dumps(prompt)))
             if include_extra_pnginfo_metadata == True:
                 if extra_pnginfo is not None:
                     for x in extra_pnginfo:
-                        result.add_text(x, json.dumps(extra_pnginfo[x]))
+                        if x == "workflow" and workflow_sidecar:
+                            result.append(("workflow_sidecar", self.save_sidecar(json.dumps(extra_pnginfo[x]))))
+                        else:
+                            result.append((x, json.dumps(extra_pnginfo[x])))
             if extra_metadata is not None:
-                result.add_text("Extra", extra_metadata)
+                result.append(("Extra", extra_metadata))
         return result
-        
 
-    def save_images(self, images, filename_prefix, include_node_metadata, include_extra_pnginfo_metadata, param_metadata = None, extra_metadata=None, prompt=None, extra_pnginfo=None):
+    def set_metadata(self, include_node_metadata, include_extra_pnginfo_metadata, param_metadata = None, extra_metadata=None, prompt=None, extra_pnginfo=None, compress=False, workflow_sidecar=False):
+        result = None
+        if not cli_args.args.disable_metadata:
+            result = PngInfo()
+            for key, text in self.metadata_text(include_node_metadata, include_extra_pnginfo_metadata, param_metadata, extra_metadata, prompt, extra_pnginfo, workflow_sidecar):
+                if compress and key != "parameters" and len(text) > self.compress_threshold:
+                    result.add_itxt(key, text, zip=True)
+                else:
+                    result.add_text(key, text)
+        return result
+
+    def build_exif(self, text):
+        # parameters goes in the UserComment, the way A1111 writes it, so Civitai can read it.
+        # Everything else is stored as "key:value" strings starting at 0x0110 and counting down, the same as ComfyUI's webp saving.
+        exif = Image.Exif()
+        tag = 0x0110
+        for key, value in text:
+            if key == "parameters":
+                exif[0x8769] = {0x9286: b"UNICODE\x00" + value.encode("utf-16-be")}
+            else:
+                exif[tag] = f"{key}:{value}"
+                tag -= 1
+        return exif.tobytes()
+
+    def set_exif(self, file_format, include_node_metadata, include_extra_pnginfo_metadata, param_metadata = None, extra_metadata=None, prompt=None, extra_pnginfo=None, workflow_sidecar=False):
+        text = self.metadata_text(include_node_metadata, include_extra_pnginfo_metadata, param_metadata, extra_metadata, prompt, extra_pnginfo, workflow_sidecar)
+        if not text:
+            return None
+
+        result = self.build_exif(text)
+        # JPEG can only hold 64k of EXIF, which a big workflow will go over. Keep the parameters rather than fail the save.
+        if file_format == "jpeg" and len(result) > 65533:
+            print("Workflow is too large to fit in the JPEG's EXIF data, only saving the parameters.")
+            result = self.build_exif([(key, value) for key, value in text if key == "parameters"])
+        return result
+
+    def to_uint8(self, images):
+        # Convert the whole batch in one go on whatever device it's on, then copy it over once.
+        # Indexing the result gives views into the same buffer, so there are no per-image copies.
+        return images.mul(255.).clamp_(0, 255).round_().to(torch.uint8).cpu().numpy()
+
+    def save_args(self, file_format, quality, effort, metadata):
+        if file_format == "png":
+            return {"format": "PNG", "pnginfo": metadata, "compress_level": self.compress_level}
+
+        args = {"format": self.pil_formats[file_format], "quality": quality}
+        if metadata is not None:
+            args["exif"] = metadata
+        if file_format == "webp (lossless)":
+            args.update(lossless=True, method=effort)
+        elif file_format == "webp":
+            args["method"] = effort
+        elif file_format == "jpeg":
+            args["optimize"] = True
+        elif file_format == "avif":
+            # avif's speed runs the other way, 0 being slowest and 10 fastest.
+            args["speed"] = 10 - effort
+        return args
+
+    def save_image(self, image, path, args):
+        img = Image.fromarray(image)
+        if img.mode == "RGBA" and path.endswith(".jpg"):
+            img = img.convert("RGB")
+        # Write under a temporary name and move it into place, so a failed or interrupted save never leaves
+        # a truncated image behind under the real name.
+        tmp_path = path + ".tmp"
+        try:
+            img.save(tmp_path, **args)
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    @classmethod
+    def start_writers(cls):
+        with cls.save_writers_lock:
+            if cls.save_writers:
+                return
+            for n in range(cls.save_workers):
+                writer = threading.Thread(target=cls.writer_loop, name=f"SageUtils writer {n}", daemon=True)
+                writer.start()
+                cls.save_writers.append(writer)
+            atexit.register(cls.save_queue.join)
+
+    @classmethod
+    def writer_loop(cls):
+        while True:
+            save, image, path, args = cls.save_queue.get()
+            try:
+                save(image, path, args)
+            except Exception as e:
+                print(f"Unable to save {path}: {e}")
+            finally:
+                cls.save_queue.task_done()
+
+    def save_images(self, images, filename_prefix, include_node_metadata, include_extra_pnginfo_metadata, param_metadata = None, extra_metadata=None, async_save = False, file_format = "png", quality = 90, effort = 4, compress_metadata = False, workflow_sidecar = False, prompt=None, extra_pnginfo=None):
         filename_prefix += self.prefix_append
         full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, self.output_dir, images[0].shape[1], images[0].shape[0])
-        results = list()
-        for (batch_number, image) in enumerate(images):
-            i = 255. * image.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-            final_metadata = self.set_metadata(include_node_metadata, include_extra_pnginfo_metadata, param_metadata, extra_metadata, prompt, extra_pnginfo)
+        with self.counter_lock:
+            counter_key = (full_output_folder, filename)
+            counter = max(counter, self.next_counter.get(counter_key, 0))
+            self.next_counter[counter_key] = counter + len(images)
+
+        # The metadata is the same for every image in the batch, so only build it once.
+        if file_format == "png":
+            final_metadata = self.set_metadata(include_node_metadata, include_extra_pnginfo_metadata, param_metadata, extra_metadata, prompt, extra_pnginfo, compress_metadata, workflow_sidecar)
+        else:
+            final_metadata = self.set_exif(file_format, include_node_metadata, include_extra_pnginfo_metadata, param_metadata, extra_metadata, prompt, extra_pnginfo, workflow_sidecar)
+        args = self.save_args(file_format, quality, effort, final_metadata)
+        extension = self.extensions[file_format]
 
+        results = list()
+        paths = list()
+        for batch_number in range(len(images)):
             filename_with_batch_num = filename.replace("%batch_num%", str(batch_number))
-            file = f"{filename_with_batch_num}_{counter:05}_.png"
+            file = f"{filename_with_batch_num}_{counter:05}_.{extension}"
             
-            img.save(os.path.join(full_output_folder, file), pnginfo=final_metadata, compress_level=self.compress_level)
+            paths.append(os.path.join(full_output_folder, file))
             results.append({
                 "filename": file,
                 "subfolder": subfolder,
@@ -411,4 +563,14 @@ class Sage_SaveImageWithMetadata:
             })
             counter += 1
 
+        # The writers only ever hold this uint8 buffer, not the image tensors.
+        pixels = self.to_uint8(images)
+        if async_save:
+            self.start_writers()
+            for image, path in zip(pixels, paths):
+                self.save_queue.put((self.save_image, image, path, args))
+        else:
+            for _ in self.save_executor.map(self.save_image, pixels, paths, [args] * len(paths)):
+                pass
+
         return { "ui": { "images": results } }
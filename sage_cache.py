@@ -1,25 +1,271 @@
 import json
+import bisect
 import pathlib
+import sqlite3
+import threading
+import time
+import atexit
 import folder_paths
 
 cache_path = pathlib.Path(folder_paths.base_path) / "custom_nodes" / "ComfyUI_SageUtils" / "sage_cache.json"
+manifest_path = pathlib.Path(folder_paths.base_path) / "custom_nodes" / "ComfyUI_SageUtils" / "sage_scan_manifest.json"
+db_path = pathlib.Path(folder_paths.base_path) / "custom_nodes" / "ComfyUI_SageUtils" / "sage_cache.db"
+
+# "json" keeps everything in sage_cache.json, as it always has.
+# "sqlite" stores one row per model in sage_cache.db, so updating an entry doesn't rewrite the whole cache.
+# The first time it's used, it imports sage_cache.json.
+cache_backend = "json"
 cache_data = {}
 
+# cache_data is the authoritative copy. Changed entries are marked dirty and written out
+# in the background, flush_delay seconds after the first change, and again at exit.
+flush_delay = 5.0
+dirty = set()
+flush_timer = None
+cache_lock = threading.RLock()
+# Held for the whole of a flush or save, so an older snapshot can never be written over a newer one.
+# Always taken before cache_lock.
+flush_lock = threading.RLock()
+
+db = None
+db_lock = threading.Lock()
+
+# Civitai responses are kept in the database whichever backend is used for cache_data.
+response_cache_size = 5000
+
+class Index:
+    # Maps a key to the set of cached paths that have it, and keeps track of which keys have more than one.
+    # Background threads update it through mark_dirty(), so the readers take cache_lock and return copies.
+    def __init__(self):
+        self.paths = {}
+        self.dups = set()
+
+    def add(self, key, path):
+        paths = self.paths.setdefault(key, set())
+        paths.add(path)
+        if len(paths) > 1:
+            self.dups.add(key)
+
+    def remove(self, key, path):
+        paths = self.paths.get(key, set())
+        paths.discard(path)
+        if len(paths) < 2:
+            self.dups.discard(key)
+        if not paths:
+            self.paths.pop(key, None)
+
+    def get(self, key):
+        with cache_lock:
+            return sorted(self.paths.get(key, ()))
+
+    def duplicates(self):
+        with cache_lock:
+            return {key: sorted(self.paths[key]) for key in self.dups}
+
+    def snapshot(self):
+        with cache_lock:
+            return {key: sorted(paths) for key, paths in self.paths.items()}
+
+# Secondary indexes over cache_data, kept up to date by mark_dirty() and rebuilt by load_cache().
+by_hash = Index()
+by_model_id = Index()
+by_type = Index() # (type, baseModel)
+by_last_used = [] # sorted (lastUsed, path) pairs
+indexed = {}
+
+def index_keys(entry):
+    model = entry.get("model")
+    model_type = model.get("type") if isinstance(model, dict) else None
+    type_key = (model_type, entry["baseModel"]) if model_type is not None and "baseModel" in entry else None
+    return (entry.get("hash"), entry.get("modelId"), type_key, entry.get("lastUsed"))
+
+def update_index(path):
+    with cache_lock:
+        old = indexed.pop(path, None)
+        if old is not None:
+            for index, key in zip((by_hash, by_model_id, by_type), old):
+                if key is not None:
+                    index.remove(key, path)
+            if old[3] is not None:
+                i = bisect.bisect_left(by_last_used, (old[3], path))
+                if i < len(by_last_used) and by_last_used[i] == (old[3], path):
+                    del by_last_used[i]
+
+        if path not in cache_data:
+            return
+
+        new = index_keys(cache_data[path])
+        for index, key in zip((by_hash, by_model_id, by_type), new):
+            if key is not None:
+                index.add(key, path)
+        if new[3] is not None:
+            bisect.insort(by_last_used, (new[3], path))
+        indexed[path] = new
+
+def rebuild_index():
+    global by_hash, by_model_id, by_type, by_last_used, indexed
+    with cache_lock:
+        by_hash, by_model_id, by_type, by_last_used, indexed = Index(), Index(), Index(), [], {}
+        for path in cache_data:
+            update_index(path)
+
+def used_since(timestamp):
+    # Paths with a lastUsed at or after the given ISO timestamp, most recent last.
+    with cache_lock:
+        return [path for _, path in by_last_used[bisect.bisect_left(by_last_used, (timestamp,)):]]
+
+def get_db():
+    global db
+    if db is None:
+        db = sqlite3.connect(db_path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE IF NOT EXISTS cache (path TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        db.execute("CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, fetched REAL, accessed REAL, etag TEXT, last_modified TEXT, body TEXT)")
+        db.commit()
+    return db
+
+def import_json_cache():
+    # One-shot import of an existing sage_cache.json the first time the database is used.
+    if get_db().execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone():
+        return
+
+    if cache_path.is_file():
+        with cache_path.open("r") as read_file:
+            old_data = json.load(read_file)
+        db.executemany("INSERT OR REPLACE INTO cache (path, data) VALUES (?, ?)",
+                       ((path, json.dumps(data, separators=(",", ":"))) for path, data in old_data.items()))
+        print(f"Imported {len(old_data)} entries from {cache_path}.")
+
+    db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_imported', '1')")
+    db.commit()
+
 def load_cache():
     global cache_data
     try:
-        if cache_path.is_file():
+        if cache_backend == "sqlite":
+            with db_lock:
+                import_json_cache()
+                cache_data = {path: json.loads(data) for path, data in get_db().execute("SELECT path, data FROM cache")}
+        elif cache_path.is_file():
             with cache_path.open("r") as read_file:
                 cache_data = json.load(read_file)
     except Exception as e:
         print(f"Unable to load cache: {e}")
+    rebuild_index()
+
+def mark_dirty(path):
+    global flush_timer
+    with cache_lock:
+        update_index(path)
+        dirty.add(path)
+        if flush_timer is None:
+            flush_timer = threading.Timer(flush_delay, flush)
+            flush_timer.daemon = True
+            flush_timer.start()
+
+def flush():
+    # Write out everything marked dirty. Safe to call at any time; does nothing if nothing changed.
+    global flush_timer
+    with flush_lock:
+        with cache_lock:
+            if flush_timer is not None:
+                flush_timer.cancel()
+                flush_timer = None
+            if not dirty:
+                return
+            paths = list(dirty)
+            dirty.clear()
+
+            if cache_backend != "sqlite":
+                save_cache()
+                return
+
+            rows = [(path, json.dumps(cache_data[path], separators=(",", ":")) if path in cache_data else None) for path in paths]
+
+        try:
+            with db_lock:
+                get_db().executemany("DELETE FROM cache WHERE path = ?", ((path,) for path, data in rows if data is None))
+                db.executemany("INSERT OR REPLACE INTO cache (path, data) VALUES (?, ?)", ((path, data) for path, data in rows if data is not None))
+                db.commit()
+        except Exception as e:
+            print(f"Unable to save cache: {e}")
+            for path in paths:
+                mark_dirty(path)
+
+atexit.register(flush)
 
 def save_cache():
+    # Write the whole cache out right now.
+    with flush_lock, cache_lock:
+        dirty.clear()
+        try:
+            if not cache_data:
+                print("Skipping saving cache, as the cache is empty.")
+            elif cache_backend == "sqlite":
+                with db_lock:
+                    stored = {row[0] for row in get_db().execute("SELECT path FROM cache")}
+                    db.executemany("DELETE FROM cache WHERE path = ?", ((path,) for path in stored - cache_data.keys()))
+                    db.executemany("INSERT OR REPLACE INTO cache (path, data) VALUES (?, ?)",
+                                   ((path, json.dumps(data, separators=(",", ":"))) for path, data in cache_data.items()))
+                    db.commit()
+            else:
+                with cache_path.open("w") as output_file:
+                    json.dump(cache_data, output_file, separators=(",", ":"), sort_keys=True, indent=4)
+        except Exception as e:
+            print(f"Unable to save cache: {e}")
+
+def get_response(url):
+    # Returns the cached response for a url as a dict, or None.
+    try:
+        with db_lock:
+            row = get_db().execute("SELECT fetched, etag, last_modified, body FROM responses WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE responses SET accessed = ? WHERE url = ?", (time.time(), url))
+            db.commit()
+        return {"fetched": row[0], "etag": row[1], "last_modified": row[2], "body": row[3]}
+    except Exception as e:
+        print(f"Unable to read cached response for {url}: {e}")
+        return None
+
+def store_response(url, body, etag = None, last_modified = None):
+    now = time.time()
+    try:
+        with db_lock:
+            get_db().execute("INSERT OR REPLACE INTO responses (url, fetched, accessed, etag, last_modified, body) VALUES (?, ?, ?, ?, ?, ?)",
+                             (url, now, now, etag, last_modified, body))
+            # Drop the least recently used responses once we're over the limit.
+            db.execute("DELETE FROM responses WHERE url IN (SELECT url FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (response_cache_size,))
+            db.commit()
+    except Exception as e:
+        print(f"Unable to cache response for {url}: {e}")
+
+def refresh_response(url):
+    # The server told us our copy is still good, so restart its clock.
+    try:
+        with db_lock:
+            get_db().execute("UPDATE responses SET fetched = ? WHERE url = ?", (time.time(), url))
+            db.commit()
+    except Exception as e:
+        print(f"Unable to refresh cached response for {url}: {e}")
+
+def load_scan_manifest():
+    # What the last directory scan saw: path -> [size, mtime_ns].
+    try:
+        if manifest_path.is_file():
+            with manifest_path.open("r") as read_file:
+                return json.load(read_file)
+    except Exception as e:
+        print(f"Unable to load scan manifest: {e}")
+    return {}
+
+def save_scan_manifest(manifest):
     try:
-        if cache_data:
-            with cache_path.open("w") as output_file:
-                json.dump(cache_data, output_file, separators=(",", ":"), sort_keys=True, indent=4)
-        else:
-            print("Skipping saving cache, as the cache is empty.")
+        tmp_path = manifest_path.with_suffix(".tmp")
+        with tmp_path.open("w") as output_file:
+            json.dump(manifest, output_file, separators=(",", ":"))
+        tmp_path.replace(manifest_path)
     except Exception as e:
-        print(f"Unable to save cache: {e}")
+        print(f"Unable to save scan manifest: {e}")
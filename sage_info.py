@@ -125,20 +125,24 @@ class Sage_PopulateCache:
         return {
             "required": {
                 "base_dir": (list(folder_paths.folder_names_and_paths.keys()), {"defaultInput": False}),
+                "hash_workers": ("INT", {"defaultInput": False, "default": 4, "min": 1, "max": 64, "tooltip": "How many files to hash at once. Raise this for fast disks and many cores."}),
+                "fetch_workers": ("INT", {"defaultInput": False, "default": 4, "min": 1, "max": 16, "tooltip": "How many Civitai requests to have in flight at once. Requests are still rate limited."}),
+                "batch_size": ("INT", {"defaultInput": False, "default": 100, "min": 1, "max": 100, "tooltip": "How many hashes to look up on Civitai per request. 1 looks up each file separately."}),
+                "rescan_all": ("BOOLEAN", {"defaultInput": False, "default": False, "tooltip": "Check every file, not just the ones that are new or changed since the last scan."}),
             }
         }
         
-    RETURN_TYPES = ("STRING",)
-    RETURN_NAMES = ("list",)
+    RETURN_TYPES = ("STRING", "STRING")
+    RETURN_NAMES = ("list", "removed")
     
     FUNCTION = "get_files"
     
     CATEGORY = "Sage Utils/cache"
-    DESCRIPTION = "Calculates the hash of every model in the chosen directory and pulls civitai information. Takes forever. Returns the filenames."
+    DESCRIPTION = "Calculates the hash of every new or changed model in the chosen directory and pulls civitai information. The first scan takes forever, later ones only look at what changed. Returns the filenames, and the files that have been removed since the last scan."
     
-    def get_files(self, base_dir):
-        ret = pull_all_loras(folder_paths.folder_names_and_paths[base_dir])
-        return (f"{ret}",)
+    def get_files(self, base_dir, hash_workers = 4, fetch_workers = 4, batch_size = 100, rescan_all = False):
+        ret, removed = pull_all_loras(folder_paths.folder_names_and_paths[base_dir], hash_workers, fetch_workers, batch_size, rescan_all)
+        return (f"{ret}", f"{removed}")
 
 
 class Sage_GetFileHash:
@@ -211,7 +215,7 @@ class Sage_ModelInfoBreakout:
     DESCRIPTION = "Breaks down the model info output into the path and hash."
 
     def model_breakout(self, model_info):
-        return(model_info['path'], model_info['hash'])
+        return(model_info['path'], model_info['hash'] or get_model_hash(model_info['path']))
     
 class Sage_CacheMaintenance:
     @classmethod
@@ -230,25 +234,19 @@ class Sage_CacheMaintenance:
     DESCRIPTION = "Lets you remove entries for models that are no longer there. dup_hash returns a list of files with the same hash, and dup_model returns ones with the same civitai model id (but not neccessarily the same version)."
 
     def cache_maintenance(self, remove_ghost_entries):
-        ghost_entries = [path for path in cache.cache_data if not pathlib.Path(path).is_file()]
-        cache_by_hash = {}
-        cache_by_id = {}
-        dup_hash = {}
-        dup_id = {}
-
-        for model_path, data in cache.cache_data.items():
-            if 'hash' in data:
-                cache_by_hash.setdefault(data['hash'], []).append(model_path)
-            if 'modelId' in data:
-                cache_by_id.setdefault(data['modelId'], []).append(model_path)
+        with cache.cache_lock:
+            cached_paths = list(cache.cache_data)
+        ghost_entries = [path for path in cached_paths if not pathlib.Path(path).is_file()]
 
         if remove_ghost_entries:
-            for ghost in ghost_entries:
-                cache.cache_data.pop(ghost)
-            cache.save_cache()
+            with cache.cache_lock:
+                for ghost in ghost_entries:
+                    cache.cache_data.pop(ghost, None)
+                    cache.mark_dirty(ghost)
+            cache.flush()
 
-        dup_hash = {h: paths for h, paths in cache_by_hash.items() if len(paths) > 1}
-        dup_id = {i: paths for i, paths in cache_by_id.items() if len(paths) > 1}
+        dup_hash = cache.by_hash.duplicates()
+        dup_id = cache.by_model_id.duplicates()
 
         return (", ".join(ghost_entries), json.dumps(dup_hash, separators=(",", ":"), sort_keys=True, indent=4), json.dumps(dup_id, separators=(",", ":"), sort_keys=True, indent=4))
 
@@ -258,34 +256,66 @@ class Sage_ModelReport:
     def INPUT_TYPES(s):
         return {
             "required": {
-                "type": (("LORA", "Checkpoint"), {"defaultInput": True})
+                "type": (("LORA", "Checkpoint"), {"defaultInput": True}),
+                "include_header_info": ("BOOLEAN", {"defaultInput": False, "default": False, "tooltip": "Also read the header of each safetensors file for a tensor, dtype and architecture summary. Doesn't read the tensors themselves."})
             }
         }
         
-    RETURN_TYPES = ("STRING",)
-    RETURN_NAMES = ("model_list",)
+    RETURN_TYPES = ("STRING", "STRING")
+    RETURN_NAMES = ("model_list", "header_info")
     
     FUNCTION = "pull_list"
     CATEGORY = "Sage Utils/cache"
     DESCRIPTION = "Returns a list of models in the cache of the specified type, by base model type."
     
-    def pull_list(self, type):
+    def pull_list(self, type, include_header_info = False):
         sorted_models = {}
+        header_info = {}
         
-        for model_path in cache.cache_data.keys():
-            if 'model' in cache.cache_data[model_path]:
-                if 'type' in cache.cache_data[model_path]['model']:
-                    if cache.cache_data[model_path]['model']['type'] == type:
-                        if 'baseModel' in cache.cache_data[model_path]:
-                            baseModel = cache.cache_data[model_path]['baseModel']
-                            if baseModel not in sorted_models:
-                                sorted_models[baseModel] = []
-                            
-                            sorted_models[baseModel].append(model_path)
+        for (model_type, baseModel), paths in cache.by_type.snapshot().items():
+            if model_type == type:
+                sorted_models.setdefault(baseModel, []).extend(paths)
+
+        if include_header_info:
+            for paths in sorted_models.values():
+                for model_path in paths:
+                    if model_path.endswith(".safetensors"):
+                        try:
+                            header_info[model_path] = get_safetensors_info(model_path, False)
+                        except Exception as e:
+                            print(f"Unable to read header of {model_path}: {e}")
                         
         ret = json.dumps(sorted_models, separators=(",", ":"), sort_keys=True, indent=4)
         
-        return (ret,)
+        return (ret, json.dumps(header_info, separators=(",", ":"), sort_keys=True, indent=4))
+
+class Sage_ModelHeaderInfo:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "base_dir": (list(folder_paths.folder_names_and_paths.keys()), {"defaultInput": False}),
+                "filename": ("STRING", {"defaultInput": False}),
+            }
+        }
+        
+    RETURN_TYPES = ("STRING", "STRING")
+    RETURN_NAMES = ("summary", "metadata")
+    
+    FUNCTION = "get_header_info"
+    CATEGORY = "Sage Utils/util"
+    DESCRIPTION = "Reads just the header of a safetensors file: how many tensors there are, their dtypes and parameter count, the architecture if it says, any hashes it carries, and the training metadata. Much faster than hashing the file."
+    
+    def get_header_info(self, base_dir, filename):
+        try:
+            file_path = folder_paths.get_full_path_or_raise(base_dir, filename)
+            info = get_safetensors_info(file_path)
+        except Exception as e:
+            print(f"Unable to read header of '{filename}': {e}")
+            return ("{}", "{}")
+
+        metadata = info.pop("metadata")
+        return (json.dumps(info, separators=(",", ":"), sort_keys=True, indent=4), json.dumps(metadata, separators=(",", ":"), sort_keys=True, indent=4))
     
 class Sage_ModelInfoFromModelId:
     @classmethod
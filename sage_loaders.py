@@ -5,6 +5,8 @@ import ComfyUI_SageUtils.sage_cache as cache
 
 import torch
 import pathlib
+import weakref
+from collections import OrderedDict
 import numpy as np
 from PIL import Image, ImageOps, ImageSequence
 from PIL.PngImagePlugin import PngInfo
@@ -13,6 +15,7 @@ from PIL.PngImagePlugin import PngInfo
 import comfy
 import folder_paths
 import node_helpers
+import nodes
 
 
 class Sage_CheckpointLoaderRecent:
@@ -41,11 +44,10 @@ class Sage_CheckpointLoaderRecent:
 
     def load_checkpoint(self, ckpt_name):
         model_info = { "path": folder_paths.get_full_path_or_raise("checkpoints", ckpt_name) }
-        pull_metadata(model_info["path"], True)
-
-        model_info["hash"] = cache.cache_data[model_info["path"]]["hash"]
+        start_hash(model_info["path"])
     
         out = comfy.sd.load_checkpoint_guess_config(model_info["path"], output_vae=True, output_clip=True, embedding_directory=folder_paths.get_folder_paths("embeddings"))
+        model_info["hash"] = pull_metadata_for_loader(model_info["path"])
         result = (*out[:3], model_info)
         return (result)
     
@@ -73,11 +75,10 @@ class Sage_CheckpointLoaderSimple:
 
     def load_checkpoint(self, ckpt_name):
         model_info = { "path": folder_paths.get_full_path_or_raise("checkpoints", ckpt_name) }
-        pull_metadata(model_info["path"], True)
-
-        model_info["hash"] = cache.cache_data[model_info["path"]]["hash"]
+        start_hash(model_info["path"])
     
         out = comfy.sd.load_checkpoint_guess_config(model_info["path"], output_vae=True, output_clip=True, embedding_directory=folder_paths.get_folder_paths("embeddings"))
+        model_info["hash"] = pull_metadata_for_loader(model_info["path"])
         result = (*out[:3], model_info)
         return (result)
 
@@ -107,16 +108,22 @@ class Sage_UNETLoader:
             "name": pathlib.Path(unet_name).name,
             "path": folder_paths.get_full_path_or_raise("diffusion_models", unet_name)
         }
-        pull_metadata(model_info["path"], True)
-        model_info["hash"] = cache.cache_data[model_info["path"]]["hash"]
+        start_hash(model_info["path"])
 
         model = comfy.sd.load_diffusion_model(model_info["path"], model_options=model_options)
+        model_info["hash"] = pull_metadata_for_loader(model_info["path"])
         return model, model_info
 
 # Modified version of the main lora loader.
 class Sage_LoraStackLoader:
+    patched_size = 4
+
     def __init__(self):
-        self.loaded_lora = None
+        # Recently patched (model, clip) pairs, keyed on the base model and clip plus the stack applied to them,
+        # so running the same stack on the same model again doesn't redo the patching. Each node has its own,
+        # and entries only hold weak references to the base model and clip, so the memo never keeps a checkpoint
+        # loaded after it's been switched out.
+        self.patched = OrderedDict()
 
     @classmethod
     def INPUT_TYPES(s):
@@ -142,32 +149,110 @@ class Sage_LoraStackLoader:
             return model, clip
 
         lora_path = folder_paths.get_full_path_or_raise("loras", lora_name)
-        
-        if self.loaded_lora and self.loaded_lora[0] == lora_path:
-            lora = self.loaded_lora[1]
-        else:
-            pull_metadata(lora_path, True)
-            lora = comfy.utils.load_torch_file(lora_path, safe_load=True)
-            self.loaded_lora = (lora_path, lora)
-
+        lora = self.load_lora_file(lora_path)
         return comfy.sd.load_lora_for_models(model, clip, lora, strength_model, strength_clip)
+
+    def load_lora_file(self, lora_path):
+        lora = lora_cache.get(lora_path)
+        if lora is None:
+            start_hash(lora_path)
+            lora = comfy.utils.load_torch_file(lora_path, safe_load=True)
+            pull_metadata_for_loader(lora_path)
+            lora_cache.put(lora_path, lora)
+        else:
+            mark_used(lora_path)
+        return lora
     
+    def stack_key(self, model, clip, lora_stack):
+        stack = []
+        for lora_name, strength_model, strength_clip in (lora for lora in lora_stack if lora):
+            if strength_model or strength_clip:
+                lora_path = folder_paths.get_full_path_or_raise("loras", lora_name)
+                stack.append((lora_path, tuple(get_file_fingerprint(lora_path)), float(strength_model), float(strength_clip)))
+        return (id(model), id(clip), tuple(stack))
+
+    def ref(self, obj):
+        return None if obj is None else weakref.ref(obj)
+
+    def deref(self, ref):
+        return None if ref is None else ref()
+
     def load_loras(self, model, clip, lora_stack=None):
         if not lora_stack:
             print("No lora stacks found. Warning: Passing 'None' to lora_stack output.")
             return model, clip, None
 
+        # Patched clones can point back at the model they came from, so once a different model comes in,
+        # drop everything patched from the old one rather than waiting on the weak references.
+        for old_key, entry in list(self.patched.items()):
+            if self.deref(entry[0]) is not model or self.deref(entry[1]) is not clip:
+                self.patched.pop(old_key, None)
+
+        key = self.stack_key(model, clip, lora_stack)
+        entry = self.patched.get(key)
+        # Checking the weak references as well as the ids means a reused id can't match a different model.
+        if entry is not None and self.deref(entry[0]) is model and self.deref(entry[1]) is clip:
+            self.patched.move_to_end(key)
+            # Nothing got loaded, but these loras are still in use as far as the recent lists go.
+            for lora_path, _, _, _ in key[2]:
+                mark_used(lora_path)
+            return entry[2], entry[3], lora_stack
+
+        patched_model, patched_clip = self.apply_stack(model, clip, lora_stack)
+        print(f"Lora cache: {lora_cache.stats()}")
+
+        self.patched[key] = (self.ref(model), self.ref(clip), patched_model, patched_clip)
+        while len(self.patched) > self.patched_size:
+            self.patched.popitem(last=False)
+        return patched_model, patched_clip, lora_stack
+
+    def apply_stack(self, model, clip, lora_stack):
         for lora in lora_stack:
             if lora:
                 model, clip = self.load_lora(model, clip, *lora)
-        return model, clip, lora_stack
+        return model, clip
+
+class Sage_LoraStackLoaderFused(Sage_LoraStackLoader):
+    DESCRIPTION = "Like the Lora Stack Loader, but merges the whole stack, with its weights, into one lora file the first time it's used, and loads that single file from then on. Stacks using lora types that can't be merged are applied a lora at a time."
+
+    def apply_stack(self, model, clip, lora_stack):
+        active = [lora for lora in lora_stack if lora and (lora[1] or lora[2])]
+        if len(active) < 2:
+            return super().apply_stack(model, clip, active)
+
+        lora_paths = [folder_paths.get_full_path_or_raise("loras", lora[0]) for lora in active]
+        # Only wait for the hashes here, not for the Civitai lookups queued behind them.
+        hashes = [pull_metadata_for_loader(path) or wait_for_hash(path) for path in lora_paths]
+        fused_path = fused_lora_path([(hash, lora[1], lora[2]) for hash, lora in zip(hashes, active)])
+
+        if not fused_path.is_file():
+            fused = fuse_lora_stack([(self.load_lora_file(path), lora[1], lora[2]) for path, lora in zip(lora_paths, active)])
+            if fused is None:
+                print("Unable to merge this lora stack, applying the loras one at a time.")
+                return super().apply_stack(model, clip, active)
+            save_fused_lora(fused, fused_path)
+            print(f"Saved merged lora stack to {fused_path}.")
+        else:
+            touch_fused_lora(fused_path)
+
+        lora = lora_cache.get(str(fused_path))
+        if lora is None:
+            lora = comfy.utils.load_torch_file(str(fused_path), safe_load=True)
+            lora_cache.put(str(fused_path), lora)
+        return comfy.sd.load_lora_for_models(model, clip, lora, 1.0, 1.0)
     
 class Sage_LoadImage:
     @classmethod
     def INPUT_TYPES(s):
-        files = sorted(str(x.relative_to(folder_paths.get_input_directory())) 
-                       for x in pathlib.Path(folder_paths.get_input_directory()).rglob('*') if x.is_file())
-        return {"required": {"image": (files, {"image_upload": True})}}
+        files = input_listing.files(folder_paths.get_input_directory())
+        return {
+            "required": {
+                "image": (files, {"image_upload": True})
+            },
+            "optional": {
+                "max_size": ("INT", {"default": 0, "min": 0, "max": nodes.MAX_RESOLUTION, "step": 8, "tooltip": "If set, the image is scaled down on load so its longest side is at most this many pixels. JPEGs are decoded at reduced size directly. 0 loads at full size."})
+            }
+        }
 
     CATEGORY = "Sage Utils/loaders"
 
@@ -175,42 +260,63 @@ class Sage_LoadImage:
     RETURN_NAMES = ("image", "mask", "width", "height", "metadata")
 
     FUNCTION = "load_image"
-    def load_image(self, image):
+    def load_image(self, image, max_size = 0):
         image_path = folder_paths.get_annotated_filepath(image)
         img = node_helpers.pillow(Image.open, image_path)
-        
-        output_images, output_masks = [], []
+
+        if max_size and img.format == 'JPEG' and max(img.size) > max_size:
+            # Let the JPEG decoder skip straight to the smallest power of two scale that's still at least the size we want.
+            scale = max_size / max(img.size)
+            img.draft('RGB', (max(1, int(img.width * scale)), max(1, int(img.height * scale))))
+
+        # Decode straight into preallocated uint8 buffers, and convert to float once at the end,
+        # rather than building a float tensor per frame and concatenating them.
+        frames = 1 if img.format == 'MPO' else getattr(img, "n_frames", 1)
+        images, alpha = None, None
         w, h = None, None
+        count = 0
 
         for i in ImageSequence.Iterator(img):
+            if count == frames:
+                break
             i = node_helpers.pillow(ImageOps.exif_transpose, i)
             if i.mode == 'I':
                 i = i.point(lambda x: x * (1 / 255))
-            image = i.convert("RGB")
-
-            if not output_images:
+            has_alpha = 'A' in i.getbands()
+            # Convert before resizing. Pillow quietly uses nearest neighbour for palette and 1 bit images.
+            i = i.convert("RGBA" if has_alpha else "RGB")
+            if max_size and max(i.size) > max_size:
+                scale = max_size / max(i.size)
+                i = i.resize((max(1, round(i.width * scale)), max(1, round(i.height * scale))), Image.Resampling.LANCZOS, reducing_gap=2.0)
+            image = i.convert("RGB") if has_alpha else i
+
+            if images is None:
                 w, h = image.size
+                images = torch.empty((frames, h, w, 3), dtype=torch.uint8)
+                if has_alpha:
+                    alpha = torch.full((frames, h, w), 255, dtype=torch.uint8)
             
             if image.size != (w, h):
                 continue
             
-            image = torch.from_numpy(np.array(image).astype(np.float32) / 255.0)[None,]
-            mask = (1. - torch.from_numpy(np.array(i.getchannel('A')).astype(np.float32) / 255.0)).unsqueeze(0) if 'A' in i.getbands() else torch.zeros((1, 64, 64), dtype=torch.float32)
-            output_images.append(image)
-            output_masks.append(mask)
-
-        output_image = torch.cat(output_images, dim=0) if len(output_images) > 1 and img.format != 'MPO' else output_images[0]
-        output_mask = torch.cat(output_masks, dim=0) if len(output_masks) > 1 and img.format != 'MPO' else output_masks[0]
+            # Copy the decoded pixels straight into this frame's slot of the preallocated buffer.
+            images[count].numpy()[...] = np.asarray(image)
+            if alpha is not None and has_alpha:
+                alpha[count].numpy()[...] = np.asarray(i.getchannel('A'))
+            count += 1
+
+        output_image = images[:count].to(torch.float32).div_(255.0)
+        if alpha is not None:
+            output_mask = alpha[:count].to(torch.float32).div_(255.0).neg_().add_(1.0)
+        else:
+            output_mask = torch.zeros((count, 64, 64), dtype=torch.float32)
 
         return output_image, output_mask, w, h, f"{img.info}"
 
     @classmethod
-    def IS_CHANGED(s, image):
+    def IS_CHANGED(s, image, max_size = 0):
         image_path = folder_paths.get_annotated_filepath(image)
-        m = hashlib.sha256()
-        with open(image_path, 'rb') as f:
-            m.update(f.read())
-        return m.digest().hex()
+        return get_file_digest(image_path)
 
     @classmethod
     def VALIDATE_INPUTS(s, image):
@@ -1,16 +1,34 @@
 #Utility functions for use in the nodes.
 
+import os
 import pathlib
 import hashlib
 import requests
 import time
 import datetime
+import threading
+import queue
+import random
+import io
+import mmap
+import struct
+import email.utils
 import numpy as np
 import torch
 import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from PIL import Image, ImageOps
 from PIL.PngImagePlugin import PngInfo
-import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import HTTPError
+
+import safetensors.torch
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 import folder_paths
 import comfy.utils
@@ -20,97 +38,733 @@ import ComfyUI_SageUtils.sage_cache as cache
 def name_from_path(path):
     return pathlib.Path(path).name
 
-def get_civitai_model_version_json(hash):
+class RateLimiter:
+    # Token bucket. Each request takes a token, and tokens refill at `rate` per second, up to `burst`.
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                delay = self.paused_until - now
+                if delay <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        # Hold off every caller, not just the one that got told to slow down.
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+civitai_limiter = RateLimiter(rate=2.0, burst=5)
+
+# How long, in seconds, a Civitai response is used before asking again.
+civitai_ttl = 24 * 60 * 60
+
+def retry_after_seconds(response, default = 5.0):
+    value = response.headers.get("Retry-After", "")
     try:
-        r = requests.get("https://civitai.com/api/v1/model-versions/by-hash/" + hash)
-        r.raise_for_status()
-    except HTTPError as http_err:
-        print(f"HTTP error occurred: {http_err}")
-        return {"error": "HTTP error occurred: " + http_err}
-    except Exception as err:
-        print(f"Other error occurred: {err}")
-        return {"error": "Other error occurred: " + err}
-    else:
-        print("Retrieved json from civitai.")
-        return r.json()
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+        return max(0.0, (when - datetime.datetime.now(when.tzinfo)).total_seconds())
+    except (TypeError, ValueError):
+        return default
 
-    return r.json()
+def make_http_session(connections_per_host = 8):
+    # One keep-alive session for everything, so we aren't doing a fresh TLS handshake per request.
+    # pool_block means no more than connections_per_host connections to any one host at a time.
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=connections_per_host, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+http_session = make_http_session()
+
+# Connect and read timeouts, in seconds.
+http_timeout = (5, 30)
+
+def backoff_delay(attempt, base = 1.0, cap = 30.0):
+    # Exponential backoff with full jitter, so a pool of workers doesn't retry in lockstep.
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def http_get(url, headers = None, retries = 3, limiter = None):
+    return http_request("GET", url, headers, retries, limiter)
+
+def http_request(method, url, headers = None, retries = 3, limiter = None, json_body = None):
+    # Request through the shared session. Connection errors, timeouts and 5xx responses are retried with backoff.
+    # 429s wait for as long as the server asks, pausing everything else going through the same limiter.
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+
+        try:
+            r = http_session.request(method, url, headers=headers, json=json_body, timeout=http_timeout)
+        except (requests.ConnectionError, requests.Timeout) as err:
+            if attempt == retries:
+                raise
+            delay = backoff_delay(attempt)
+            print(f"Request to {url} failed ({err}), retrying in {delay:.1f} seconds.")
+            time.sleep(delay)
+            continue
+
+        if attempt < retries:
+            if r.status_code == 429:
+                delay = retry_after_seconds(r)
+                print(f"Rate limit hit, waiting {delay:.1f} seconds.")
+                if limiter is not None:
+                    limiter.pause(delay)
+                else:
+                    time.sleep(delay)
+                r.close()
+                continue
+            if r.status_code in (500, 502, 503, 504):
+                delay = backoff_delay(attempt)
+                print(f"Server error {r.status_code} from {url}, retrying in {delay:.1f} seconds.")
+                r.close()
+                time.sleep(delay)
+                continue
+        return r
+
+def is_fresh(cached):
+    return cached is not None and time.time() - cached["fetched"] < civitai_ttl
+
+def store_not_found(url):
+    # Not on Civitai. Remember that too, so we don't keep asking about the same file.
+    result = {"error": f"HTTP error occurred: 404 Not Found for url: {url}", "notFound": True}
+    cache.store_response(url, json.dumps(result))
+    return result
+
+def get_civitai_json(url, retries = 3):
+    # Responses are reused for civitai_ttl seconds. After that we revalidate with the server if we can.
+    cached = cache.get_response(url)
+    if is_fresh(cached):
+        print("Using cached json from civitai.")
+        return json.loads(cached["body"])
+
+    headers = {}
+    if cached is not None:
+        if cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
 
-def get_civitai_model_json(modelId):
     try:
-        r = requests.get("https://civitai.com/api/v1/models/" + str(modelId))
+        r = http_get(url, headers, retries, civitai_limiter)
+
+        if r.status_code == 304 and cached is not None:
+            cache.refresh_response(url)
+            print("Cached json from civitai is still current.")
+            return json.loads(cached["body"])
+        if r.status_code == 404:
+            print(f"Not found on civitai: {url}")
+            return store_not_found(url)
         r.raise_for_status()
+        result = r.json()
     except HTTPError as http_err:
         print(f"HTTP error occurred: {http_err}")
-        return {"error": "HTTP error occurred: " + http_err}
+        return {"error": f"HTTP error occurred: {http_err}"}
     except Exception as err:
         print(f"Other error occurred: {err}")
-        return {"error": "Other error occurred: " + err}
+        return {"error": f"Other error occurred: {err}"}
     else:
         print("Retrieved json from civitai.")
-        return r.json()
+        cache.store_response(url, r.text, r.headers.get("ETag"), r.headers.get("Last-Modified"))
+        return result
+
+def civitai_version_url(hash):
+    return "https://civitai.com/api/v1/model-versions/by-hash/" + hash
+
+def get_civitai_model_version_json(hash):
+    return get_civitai_json(civitai_version_url(hash))
+
+def get_civitai_model_versions_bulk(hashes):
+    # Look up a batch of hashes in one request. Returns a dict of hash -> model version json, and stores
+    # each in the response cache as if it had been fetched by itself. Civitai just leaves out hashes it
+    # doesn't know, so those get the same not found response a single lookup would have.
+    r = http_request("POST", "https://civitai.com/api/v1/model-versions/by-hash", limiter=civitai_limiter, json_body=list(hashes))
+    r.raise_for_status()
 
-    return r.json()
+    wanted = set(hashes)
+    found = {}
+    for version in r.json():
+        for file in version.get("files", []):
+            file_hashes = file.get("hashes", {})
+            # Our hashes are the first 10 characters of the sha256, which is what Civitai calls AutoV2.
+            for value in (file_hashes.get("AutoV2", ""), file_hashes.get("SHA256", "")[:10]):
+                if value.lower() in wanted:
+                    found[value.lower()] = version
 
-def get_file_sha256(path):
+    for hash, version in found.items():
+        cache.store_response(civitai_version_url(hash), json.dumps(version))
+    print(f"Retrieved {len(found)} of {len(wanted)} hashes from civitai in one request.")
+
+    for hash in wanted - found.keys():
+        found[hash] = store_not_found(civitai_version_url(hash))
+    return found
+
+def get_civitai_model_json(modelId):
+    return get_civitai_json("https://civitai.com/api/v1/models/" + str(modelId))
+
+def get_file_fingerprint(path):
+    # Size, modification time and inode. If any of these change, the file needs rehashing.
+    st = pathlib.Path(path).stat()
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+def update_hash_from_file(m, path, chunk_size = 1024 * 1024):
+    # Feed a file into a hash object a chunk at a time, so memory use doesn't depend on the file size.
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while (size := f.readinto(buffer)):
+            m.update(view[:size])
+    return m
+
+def get_file_sha256(path, chunk_size = 1024 * 1024):
     print(f"Calculating hash for {path}")
-    m = hashlib.sha256()
-    
-    with open(path, 'rb') as f:
-        m.update(f.read())
-        
+    m = update_hash_from_file(hashlib.sha256(), path, chunk_size)
+
     result = str(m.digest().hex()[:10])
     print(f"Got hash {result}")
     return result
 
+# Digests of files that only need change detection, remembered until the file's fingerprint changes.
+file_digests = {}
+file_digests_lock = threading.Lock()
+
+def get_file_digest(path):
+    fingerprint = get_file_fingerprint(path)
+    with file_digests_lock:
+        cached = file_digests.get(path)
+    if cached is not None and cached[0] == fingerprint:
+        return cached[1]
+
+    # xxhash is much faster if it's installed, and we don't need a cryptographic hash to notice a change.
+    m = xxhash.xxh3_128() if xxhash is not None else hashlib.sha256()
+    digest = update_hash_from_file(m, path).hexdigest()
+    with file_digests_lock:
+        file_digests[path] = (fingerprint, digest)
+    return digest
+
+def hash_with_fingerprint(path):
+    # Fingerprint first, so a file modified mid-hash gets picked up again next time.
+    fingerprint = get_file_fingerprint(path)
+    return get_file_sha256(path), fingerprint
+
+def cached_hash(file_path, fingerprint):
+    # The cached hash, or an empty string if there isn't one or the file has changed since.
+    file_cache = cache.cache_data.get(file_path, {})
+    if "fingerprint" in file_cache and file_cache["fingerprint"] != fingerprint:
+        return ""
+    return file_cache.get("hash", "")
+
+def store_hash(file_path, hash, fingerprint):
+    # New or changed file, so anything we knew about it is stale.
+    cache.cache_data[file_path] = {"hash": hash, "fingerprint": fingerprint}
+
+# Files currently being hashed by start_hash(), so that nothing hashes the same file twice at once.
+hash_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="SageUtils hash")
+hash_futures = {}
+hash_futures_lock = threading.Lock()
+
+def hash_and_store(file_path, fingerprint):
+    try:
+        hash = get_file_sha256(file_path)
+        with cache.cache_lock:
+            store_hash(file_path, hash, fingerprint)
+            cache.mark_dirty(file_path)
+        return hash
+    finally:
+        with hash_futures_lock:
+            hash_futures.pop(file_path, None)
+
+def start_hash(file_path):
+    # Start hashing a file in the background, unless its cached hash is still good or it's already underway.
+    # Loaders call this just before loading, so the hash and the load read the file at the same time
+    # and it only has to come off the disk once. Returns a future for the hash, or None.
+    fingerprint = get_file_fingerprint(file_path)
+    with cache.cache_lock:
+        if cached_hash(file_path, fingerprint):
+            return None
+
+    with hash_futures_lock:
+        future = hash_futures.get(file_path)
+        if future is None:
+            future = hash_executor.submit(hash_and_store, file_path, fingerprint)
+            hash_futures[file_path] = future
+    return future
+
+def hash_files(paths, workers = 4, max_inflight_bytes = 8 * 1024 ** 3, pbar = None):
+    # Hash files on a pool of workers, limiting how many bytes are being read at once.
+    # Returns a dict of path -> (hash, fingerprint). Files that fail to hash are left out.
+    results = {}
+    pending = {}
+    inflight = 0
+
+    def collect(done):
+        nonlocal inflight
+        for future in done:
+            path, size = pending.pop(future)
+            inflight -= size
+            try:
+                results[path] = future.result()
+            except Exception as e:
+                print(f"Unable to hash {path}: {e}")
+            if pbar is not None:
+                pbar.update(1)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for path in paths:
+            try:
+                size = pathlib.Path(path).stat().st_size
+            except OSError as e:
+                print(f"Unable to hash {path}: {e}")
+                if pbar is not None:
+                    pbar.update(1)
+                continue
+
+            while pending and inflight + size > max_inflight_bytes:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+
+            pending[executor.submit(hash_with_fingerprint, path)] = (path, size)
+            inflight += size
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+
+    return results
+
+def civitai_pull_needed(file_cache):
+    if 'lastUsed' in file_cache and 'civitai' in file_cache:
+        last_used = datetime.datetime.fromisoformat(file_cache['lastUsed'])
+        if (datetime.datetime.now() - last_used).days == 0:
+            return False
+    return True
+
+def civitai_lookup_settled(file_cache):
+    # True once Civitai has either sent the model's info or told us it doesn't have it.
+    # A lookup that failed any other way doesn't count.
+    return file_cache.get('civitai') == "True" or file_cache.get('notFound', False)
+
+def update_civitai_info(file_cache, json):
+    if 'error' in json:
+        print(f"Error: {json['error']}")
+        file_cache['civitai'] = file_cache.get('model', "False")
+        # Older cached 404s don't have the notFound flag, only the message.
+        if json.get('notFound') or "404 Not Found" in str(json['error']):
+            file_cache['notFound'] = True
+    else:
+        file_cache.pop('notFound', None)
+        file_cache.update({
+            'civitai': "True",
+            'model': json["model"],
+            'name': json["name"],
+            'baseModel': json["baseModel"],
+            'id': json["id"],
+            'modelId': json["modelId"],
+            'trainedWords': json["trainedWords"],
+            'downloadUrl': json["downloadUrl"]
+        })
+        print("Successfully pulled metadata.")
+
 def pull_metadata(file_path, timestamp = False):
-    cache.load_cache()
-    
     print(f"Pull metadata for {file_path}.")
-    hash = cache.cache_data.get(file_path, {}).get("hash", "")
+    fingerprint = get_file_fingerprint(file_path)
+
+    with cache.cache_lock:
+        hash = cached_hash(file_path, fingerprint)
+        if hash:
+            # Entries from before fingerprints were stored keep their hash, and pick up a fingerprint now.
+            cache.cache_data[file_path]["fingerprint"] = fingerprint
 
     if not hash:
-        cache.cache_data[file_path] = {"hash": get_file_sha256(file_path)}
+        # Join a hash that's already running for this file rather than reading it again.
+        future = start_hash(file_path)
+        if future is not None:
+            future.result()
         hash = cache.cache_data[file_path]["hash"]
-    else:
-        time.sleep(3)
-    
-    try:
-        pull_json = True
-        file_cache = cache.cache_data.get(file_path, {})
-        
-        if 'lastUsed' in file_cache and 'civitai' in file_cache:
-            last_used = datetime.datetime.fromisoformat(file_cache['lastUsed'])
-            if (datetime.datetime.now() - last_used).days == 0:
-                print("Pulled earlier today. No pull needed.")
-                pull_json = False
 
-        if pull_json:
+    file_cache = cache.cache_data[file_path]
+    try:
+        if civitai_pull_needed(file_cache):
             json = get_civitai_model_version_json(hash)
-            if 'error' in json:
-                print(f"Error: {json['error']}")
-                file_cache['civitai'] = file_cache.get('model', "False")
-            else:
-                file_cache.update({
-                    'civitai': "True",
-                    'model': json["model"],
-                    'name': json["name"],
-                    'baseModel': json["baseModel"],
-                    'id': json["id"],
-                    'modelId': json["modelId"],
-                    'trainedWords': json["trainedWords"],
-                    'downloadUrl': json["downloadUrl"]
-                })
-                print("Successfully pulled metadata.")
+            with cache.cache_lock:
+                update_civitai_info(file_cache, json)
+        else:
+            print("Pulled earlier today. No pull needed.")
     except Exception as e:
         print(f"Failed to pull metadata for {file_path} with hash {hash}: {e}")
         file_cache['civitai'] = file_cache.get('civitai', "False")
 
-    if timestamp:
+    with cache.cache_lock:
+        if timestamp:
+            file_cache['lastUsed'] = datetime.datetime.now().isoformat()
+
+        cache.cache_data[file_path] = file_cache
+        cache.mark_dirty(file_path)
+
+# With offline_first, loaders use whatever is already cached and leave hashing and Civitai
+# pulls to a background thread, so a slow network or an unhashed file doesn't hold up loading.
+offline_first = True
+metadata_queue = queue.Queue()
+metadata_pending = {} # path -> [threading.Event, timestamp]
+metadata_lock = threading.Lock()
+metadata_worker = None
+
+def metadata_worker_loop():
+    while True:
+        file_path = metadata_queue.get()
+        with metadata_lock:
+            event, timestamp = metadata_pending[file_path]
+        try:
+            pull_metadata(file_path, timestamp)
+        except Exception as e:
+            print(f"Background metadata pull for {file_path} failed: {e}")
+        finally:
+            with metadata_lock:
+                metadata_pending.pop(file_path)
+            event.set()
+
+def queue_metadata_pull(file_path, timestamp = False):
+    global metadata_worker
+    with metadata_lock:
+        if file_path in metadata_pending:
+            metadata_pending[file_path][1] |= timestamp
+            return
+        metadata_pending[file_path] = [threading.Event(), timestamp]
+        metadata_queue.put(file_path)
+
+        if metadata_worker is None:
+            metadata_worker = threading.Thread(target=metadata_worker_loop, name="SageUtils metadata", daemon=True)
+            metadata_worker.start()
+
+def wait_for_metadata(file_path):
+    # Block until any queued pull for this file has finished.
+    with metadata_lock:
+        pending = metadata_pending.get(file_path)
+    if pending is not None:
+        pending[0].wait()
+
+def pull_metadata_for_loader(file_path):
+    # Returns the file's hash if we know it. In offline_first mode that may be an empty string,
+    # and the hash gets filled in later; use get_model_hash() when the hash is actually needed.
+    if not offline_first:
+        pull_metadata(file_path, True)
+        return cache.cache_data[file_path]["hash"]
+
+    queue_metadata_pull(file_path, True)
+    with cache.cache_lock:
+        return cached_hash(file_path, get_file_fingerprint(file_path))
+
+def mark_used(file_path):
+    # Refresh lastUsed for a model that was served from memory, without going through a metadata pull.
+    with cache.cache_lock:
+        file_cache = cache.cache_data.get(file_path)
+        if file_cache is None:
+            return
         file_cache['lastUsed'] = datetime.datetime.now().isoformat()
+        cache.mark_dirty(file_path)
+
+def wait_for_hash(file_path):
+    # Just the hash, hashing the file if needed, without waiting on any Civitai lookup queued for it.
+    future = start_hash(file_path)
+    if future is not None:
+        return future.result()
+    with cache.cache_lock:
+        return cached_hash(file_path, get_file_fingerprint(file_path))
+
+def get_model_hash(file_path):
+    # For nodes that need the hash: waits for a queued pull if there is one, and only hashes if nothing is cached.
+    wait_for_metadata(file_path)
+    with cache.cache_lock:
+        hash = cached_hash(file_path, get_file_fingerprint(file_path))
+    if not hash:
+        pull_metadata(file_path)
+        hash = cache.cache_data[file_path]["hash"]
+    return hash
+
+def fetch_civitai_info(paths, workers = 4, pbar = None, batch_size = 100):
+    # Pull Civitai info for already hashed files, a few requests at a time. The rate limiter
+    # decides how fast we actually go; results are written back to the cache on this thread.
+    # Hashes we don't have a fresh response for are looked up batch_size at a time, and only
+    # a batch that fails falls back to looking its hashes up one by one.
+    needed = {}
+    for path in paths:
+        file_cache = cache.cache_data.get(path, {})
+        if "hash" in file_cache and civitai_pull_needed(file_cache):
+            needed.setdefault(file_cache["hash"], []).append(path)
+        elif pbar is not None:
+            pbar.update(1)
+
+    def apply(hash, json):
+        for path in needed[hash]:
+            file_cache = cache.cache_data[path]
+            with cache.cache_lock:
+                try:
+                    update_civitai_info(file_cache, json)
+                except Exception as e:
+                    print(f"Failed to pull metadata for {path} with hash {hash}: {e}")
+                    file_cache['civitai'] = file_cache.get('civitai', "False")
+                cache.mark_dirty(path)
+            if pbar is not None:
+                pbar.update(1)
+
+    pending = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        def lookup(hash):
+            pending[executor.submit(get_civitai_model_version_json, hash)] = ("single", hash)
+
+        if batch_size > 1:
+            to_batch = [hash for hash in needed if not is_fresh(cache.get_response(civitai_version_url(hash)))]
+            for hash in needed.keys() - set(to_batch):
+                lookup(hash)
+            for i in range(0, len(to_batch), batch_size):
+                batch = to_batch[i:i + batch_size]
+                pending[executor.submit(get_civitai_model_versions_bulk, batch)] = ("bulk", batch)
+        else:
+            for hash in needed:
+                lookup(hash)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, key = pending.pop(future)
+                if kind == "single":
+                    try:
+                        apply(key, future.result())
+                    except Exception as e:
+                        apply(key, {"error": f"Other error occurred: {e}"})
+                    continue
+
+                try:
+                    found = future.result()
+                except Exception as e:
+                    print(f"Bulk lookup failed, looking up {len(key)} hashes individually: {e}")
+                    for hash in key:
+                        lookup(hash)
+                    continue
+                for hash in key:
+                    apply(hash, found[hash])
+
+class LoraCache:
+    # Loaded lora state dicts, shared by every lora stack loader, least recently used dropped first
+    # once they take up more than max_bytes. Keyed on the file's fingerprint too, so a changed file is reloaded.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # (path, fingerprint) -> (state dict, size in bytes)
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        key = (path, tuple(get_file_fingerprint(path)))
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+            return None
+
+    def put(self, path, lora):
+        key = (path, tuple(get_file_fingerprint(path)))
+        size = sum(t.nbytes for t in lora.values() if torch.is_tensor(t))
+        with self.lock:
+            for old_key in [k for k in self.entries if k[0] == path]:
+                self.total -= self.entries.pop(old_key)[1]
+            if size > self.max_bytes:
+                return
+
+            self.entries[key] = (lora, size)
+            self.total += size
+            while self.total > self.max_bytes:
+                _, (_, old_size) = self.entries.popitem(last=False)
+                self.total -= old_size
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.total, "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+lora_cache = LoraCache(max_bytes=4 * 1024 ** 3)
+
+fused_lora_dir = pathlib.Path(folder_paths.base_path) / "custom_nodes" / "ComfyUI_SageUtils" / "fused_loras"
+# Merged loras past this are deleted, least recently used first. Using one bumps its mtime.
+fused_lora_max_bytes = 8 * 1024 ** 3
+
+# Suffix pairs for plain low rank loras that can be fused by stacking their ranks. Anything else
+# (LoCon mid weights, LoHa, LoKr, DoRA, full diffs...) can't, and the stack gets applied a lora at a time.
+lora_key_styles = (
+    (".lora_up.weight", ".lora_down.weight"),
+    (".lora_B.weight", ".lora_A.weight"),
+    (".lora.up.weight", ".lora.down.weight"),
+)
+
+def is_clip_lora_key(key):
+    return key.startswith(("lora_te", "text_encoder", "te_", "te1", "te2"))
+
+def split_lora(lora):
+    # Returns (style, {prefix: {"up": tensor, "down": tensor, "alpha": value}}), or None if the lora isn't a plain one.
+    style = None
+    layers = {}
+    for key, tensor in lora.items():
+        if key.endswith(".alpha"):
+            layers.setdefault(key[:-len(".alpha")], {})["alpha"] = float(tensor)
+            continue
+        for key_style in lora_key_styles:
+            if key.endswith(key_style[0]) or key.endswith(key_style[1]):
+                if style not in (None, key_style):
+                    return None
+                style = key_style
+                part = "up" if key.endswith(key_style[0]) else "down"
+                layers.setdefault(key[:-len(key_style[0 if part == "up" else 1])], {})[part] = tensor
+                break
+        else:
+            return None
 
-    cache.cache_data[file_path] = file_cache
-    cache.save_cache()
+    if style is None or any("up" not in layer or "down" not in layer for layer in layers.values()):
+        return None
+    return style, layers
+
+def fuse_lora_stack(loras):
+    # Merge (state dict, strength_model, strength_clip) loras into one lora by concatenating along the rank.
+    # Each lora's alpha / rank and strength is folded into its up weights, and the result's alpha equals its rank,
+    # so it's applied with a strength of 1.0. Returns None if any of the loras can't be fused this way.
+    style = None
+    fused_layers = {}
+    for lora, strength_model, strength_clip in loras:
+        split = split_lora(lora)
+        if split is None or style not in (None, split[0]):
+            return None
+        style = split[0]
+
+        for prefix, layer in split[1].items():
+            strength = strength_clip if is_clip_lora_key(prefix) else strength_model
+            if not strength:
+                continue
+            rank = layer["down"].shape[0]
+            scale = layer.get("alpha", rank) / rank * strength
+            fused_layers.setdefault(prefix, []).append((layer["up"], scale, layer["down"]))
+
+    fused = {}
+    for prefix, parts in fused_layers.items():
+        ups = [up for up, _, _ in parts]
+        downs = [down for _, _, down in parts]
+        if any(up.ndim != ups[0].ndim or up.shape[0] != ups[0].shape[0] or up.shape[2:] != ups[0].shape[2:] for up in ups):
+            return None
+        if any(down.shape[1:] != downs[0].shape[1:] for down in downs):
+            return None
+
+        dtype = ups[0].dtype
+        for t in ups + downs:
+            dtype = torch.promote_types(dtype, t.dtype)
+        up = torch.cat([(up.float() * scale).to(dtype) for up, scale, _ in parts], dim=1)
+        down = torch.cat([down.to(dtype) for down in downs], dim=0)
+        fused[prefix + style[0]] = up.contiguous()
+        fused[prefix + style[1]] = down.contiguous()
+        fused[prefix + ".alpha"] = torch.tensor(float(down.shape[0]))
+    return fused
+
+def fused_lora_path(stack):
+    # Content addressed: the name comes from the hashes and weights of the loras that went into it.
+    key = json.dumps([[hash, float(strength_model), float(strength_clip)] for hash, strength_model, strength_clip in stack])
+    return fused_lora_dir / f"{hashlib.sha256(key.encode()).hexdigest()[:32]}.safetensors"
+
+def save_fused_lora(fused, path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    safetensors.torch.save_file(fused, str(tmp_path))
+    os.replace(tmp_path, path)
+    prune_fused_loras(path)
+
+def touch_fused_lora(path):
+    try:
+        os.utime(path)
+    except OSError as e:
+        print(f"Unable to update {path}: {e}")
+
+def prune_fused_loras(keep = None):
+    files = []
+    for path in fused_lora_dir.glob("*.safetensors"):
+        try:
+            st = path.stat()
+        except OSError:
+            continue
+        files.append((st.st_mtime_ns, st.st_size, path))
+
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= fused_lora_max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            path.unlink()
+            total -= size
+            print(f"Removed merged lora {path.name} to stay under the size limit.")
+        except OSError as e:
+            print(f"Unable to remove {path}: {e}")
+
+def read_safetensors_header(path):
+    # The header is an 8 byte little endian length followed by that much json, so we can map the file
+    # and read just that, without touching any of the tensor data.
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if len(mm) < 8:
+            raise ValueError(f"{path} is too small to be a safetensors file.")
+        size = struct.unpack("<Q", mm[:8])[0]
+        if size > len(mm) - 8:
+            raise ValueError(f"{path} has a header larger than the file.")
+        return json.loads(mm[8:8 + size])
+
+def get_safetensors_info(path, include_metadata = True):
+    header = read_safetensors_header(path)
+    metadata = header.pop("__metadata__", None) or {}
+
+    dtypes = {}
+    parameters = 0
+    largest = None
+    for name, tensor in header.items():
+        dtypes[tensor["dtype"]] = dtypes.get(tensor["dtype"], 0) + 1
+        count = 1
+        for dim in tensor["shape"]:
+            count *= dim
+        parameters += count
+        if largest is None or count > largest[1]:
+            largest = (name, count, tensor["shape"])
+
+    info = {
+        "tensors": len(header),
+        "parameters": parameters,
+        "dtypes": dtypes,
+        "largest_tensor": {"name": largest[0], "shape": largest[2]} if largest else None,
+        "architecture": metadata.get("modelspec.architecture") or metadata.get("ss_base_model_version", ""),
+        "hashes": {key: value for key, value in metadata.items() if key in ("modelspec.hash_sha256", "sshs_model_hash", "sshs_legacy_hash")},
+    }
+    if include_metadata:
+        info["metadata"] = metadata
+    return info
 
 def lora_to_string(lora_name, model_weight, clip_weight):
     lora_string = ' <lora:' + str(pathlib.Path(lora_name).name) + ":" + str(model_weight) +  ">" #  + ":" + str(clip_weight)
@@ -140,11 +794,10 @@ def add_lora_to_stack(lora_name, model_weight, clip_weight, lora_stack = None):
 
 def get_lora_hash(lora_name):
     lora_path = folder_paths.get_full_path_or_raise("loras", lora_name)
-    pull_metadata(lora_path)
-
-    return cache.cache_data[lora_path]["hash"]
+    return get_model_hash(lora_path)
 
 def get_model_info(lora_path, weight = None):
+    wait_for_metadata(lora_path)
     ret = {}
     try:
         ret["type"] = cache.cache_data[lora_path]["model"]["type"]
@@ -157,21 +810,75 @@ def get_model_info(lora_path, weight = None):
         ret = {}
     return ret
     
-def pull_all_loras(the_path):
-    the_paths = the_path[0]
-    ret = []
-    for dir in the_paths:
-        result = list(p.resolve() for p in pathlib.Path(dir).glob("**/*") if p.suffix in {".safetensors", ".ckpt"})
-        ret.extend(result)
-
-    ret = list(set(ret))
-    print(f"There are {len(ret)} files.")
-    pbar = comfy.utils.ProgressBar(len(ret))
-    for the_model in ret:
-        pbar.update(1)
-        pull_metadata(str(the_model))
+def scan_model_files(dirs, suffixes = (".safetensors", ".ckpt")):
+    # Walk the directories with scandir, returning {path: [size, mtime_ns]} for every model file.
+    # Only the top level directories and any symlinks get resolved, rather than every file.
+    found = {}
+    stack = [os.path.realpath(dir) for dir in dirs if os.path.isdir(dir)]
+    seen_dirs = set()
+    while stack:
+        dir = stack.pop()
+        if dir in seen_dirs:
+            continue
+        seen_dirs.add(dir)
+        try:
+            with os.scandir(dir) as entries:
+                for entry in entries:
+                    path = os.path.realpath(entry.path) if entry.is_symlink() else entry.path
+                    if entry.is_dir():
+                        stack.append(path)
+                    elif entry.name.endswith(suffixes) and entry.is_file():
+                        st = entry.stat()
+                        found[path] = [st.st_size, st.st_mtime_ns]
+        except OSError as e:
+            print(f"Unable to scan {dir}: {e}")
+    return found
+
+def pull_all_loras(the_path, hash_workers = 4, fetch_workers = 4, batch_size = 100, rescan_all = False):
+    # Compares the directories against the manifest from the last scan, so only new or modified files
+    # are hashed and looked up. Returns the files found, and the ones that have gone since the last scan.
+    found = scan_model_files(the_path[0])
+    print(f"There are {len(found)} files.")
+
+    manifest = cache.load_scan_manifest()
+    roots = tuple(os.path.join(os.path.realpath(dir), "") for dir in the_path[0])
+    removed = sorted(path for path in manifest if path.startswith(roots) and path not in found)
+    for path in removed:
+        manifest.pop(path)
+
+    changed = [path for path, stat in found.items()
+               if rescan_all or manifest.get(path) != stat or "hash" not in cache.cache_data.get(path, {})]
+    print(f"{len(changed)} files are new or modified, {len(removed)} are gone.")
+
+    to_hash = []
+    for path in changed:
+        try:
+            if not cached_hash(path, get_file_fingerprint(path)):
+                to_hash.append(path)
+        except OSError as e:
+            print(f"Unable to stat {path}: {e}")
+    print(f"{len(to_hash)} files need hashing.")
+
+    pbar = comfy.utils.ProgressBar(len(to_hash) + len(changed))
+    for path, (hash, fingerprint) in hash_files(to_hash, hash_workers, pbar=pbar).items():
+        with cache.cache_lock:
+            store_hash(path, hash, fingerprint)
+            cache.mark_dirty(path)
+
+    fetch_civitai_info(changed, fetch_workers, pbar, batch_size)
+    cache.flush()
+
+    # Only record files Civitai has given us an answer for. Anything that failed with a network error,
+    # a 5xx or a 429 is left out, so the next scan tries it again.
+    for path in changed:
+        file_cache = cache.cache_data.get(path, {})
+        if "hash" in file_cache and civitai_lookup_settled(file_cache):
+            manifest[path] = found[path]
+        else:
+            manifest.pop(path, None)
+    cache.save_scan_manifest(manifest)
     
-    return ret
+    return sorted(found), removed
 
 def pull_lora_image_urls(hash, nsfw):
     json = get_civitai_model_version_json(hash)
@@ -185,28 +892,89 @@ def pull_lora_image_urls(hash, nsfw):
     return img_list
 
 def url_to_torch_image(url):
-    img = Image.open(requests.get(url, stream=True).raw)
+    r = http_get(url)
+    r.raise_for_status()
+    img = Image.open(io.BytesIO(r.content))
     img = ImageOps.exif_transpose(img)
     img = np.array(img.convert("RGB")).astype(np.float32) / 255.0
     return (torch.from_numpy(img)[None,])
 
+class DirectoryListing:
+    # A sorted, recursive listing of the files under a directory. Each call only stats the directories,
+    # and rescans the ones whose mtime has changed, so an unchanged tree costs almost nothing to list again.
+    def __init__(self):
+        self.root = None
+        self.dirs = {} # relative dir -> (mtime_ns, file names, subdir names)
+        self.listing = []
+        self.lock = threading.Lock()
+
+    def files(self, root):
+        with self.lock:
+            if root != self.root:
+                self.root = root
+                self.dirs = {}
+                self.listing = []
+
+            new_dirs = {}
+            changed = False
+            stack = [""]
+            while stack:
+                rel = stack.pop()
+                full = os.path.join(root, rel)
+                try:
+                    mtime = os.stat(full).st_mtime_ns
+                except OSError:
+                    changed = True
+                    continue
+
+                entry = self.dirs.get(rel)
+                if entry is None or entry[0] != mtime:
+                    file_names, subdirs = [], []
+                    try:
+                        with os.scandir(full) as entries:
+                            for e in entries:
+                                if e.is_dir(follow_symlinks=False):
+                                    subdirs.append(e.name)
+                                elif e.is_file():
+                                    file_names.append(e.name)
+                    except OSError as e:
+                        print(f"Unable to list {full}: {e}")
+                    # A directory changed within the last couple of seconds may change again without its
+                    # mtime moving on, so don't trust it until it settles.
+                    if time.time_ns() - mtime < 2_000_000_000:
+                        mtime = None
+                    entry = (mtime, file_names, subdirs)
+                    changed = True
+
+                new_dirs[rel] = entry
+                stack.extend(os.path.join(rel, subdir) for subdir in entry[2])
+
+            if changed or new_dirs.keys() != self.dirs.keys():
+                self.listing = sorted(os.path.join(rel, name) for rel, (_, file_names, _) in new_dirs.items() for name in file_names)
+            self.dirs = new_dirs
+            return self.listing
+
+input_listing = DirectoryListing()
+
 def get_recently_used_models(model_type):
-        model_list = list()
-        full_model_list = folder_paths.get_filename_list(model_type)
-        for item in full_model_list:
-            model_path = folder_paths.get_full_path_or_raise(model_type, item)
-            if model_path not in cache.cache_data.keys():
-                continue
-            
-            if 'lastUsed' not in cache.cache_data[model_path]:
-                continue
-            
-            last = cache.cache_data[model_path]['lastUsed']
-            last_used = datetime.datetime.fromisoformat(last)
-            #print(f"{model_path} - last: {last} last_used: {last_used}")
-            if (datetime.datetime.now() - last_used).days <= 7:
-                model_list.append(item)
-        return model_list
+        # Anything used within the last week, found through the lastUsed index rather than checking every model.
+        cutoff = (datetime.datetime.now() - datetime.timedelta(days=8)).isoformat()
+        recent = cache.used_since(cutoff)
+        if not recent:
+            return []
+
+        full_model_list = set(folder_paths.get_filename_list(model_type))
+        model_list = set()
+        for base in folder_paths.get_folder_paths(model_type):
+            # Only look at paths under this folder. relpath raises on Windows if they're on different drives.
+            prefix = os.path.join(os.path.normcase(os.path.abspath(base)), "")
+            for model_path in recent:
+                if not os.path.normcase(os.path.abspath(model_path)).startswith(prefix):
+                    continue
+                item = os.path.relpath(model_path, base)
+                if item in full_model_list:
+                    model_list.add(item)
+        return sorted(model_list)
 
 def civitai_sampler_name(sampler_name, scheduler_name):
     comfy_to_auto = {
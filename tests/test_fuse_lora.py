@@ -0,0 +1,64 @@
+# Checks the lora stack merging against applying each lora by itself, on CPU with small synthetic loras.
+# Run from inside a ComfyUI install, since sage_utils imports pieces of ComfyUI.
+import pathlib
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+safetensors_torch = pytest.importorskip("safetensors.torch")
+
+package_dir = pathlib.Path(__file__).resolve().parents[1]
+sys.path[:0] = [str(package_dir.parents[1]), str(package_dir.parent)]
+pytest.importorskip("folder_paths")
+sage_utils = pytest.importorskip("ComfyUI_SageUtils.sage_utils")
+
+layers = {
+    "lora_unet_down_blocks_0_attn1_to_q": (64, 32),
+    "lora_te1_text_model_encoder_layers_0_mlp_fc1": (48, 16),
+}
+
+def make_lora(path, rank, alpha, seed):
+    generator = torch.Generator().manual_seed(seed)
+    lora = {}
+    for prefix, (out_features, in_features) in layers.items():
+        lora[prefix + ".lora_up.weight"] = torch.randn(out_features, rank, generator=generator)
+        lora[prefix + ".lora_down.weight"] = torch.randn(rank, in_features, generator=generator)
+        lora[prefix + ".alpha"] = torch.tensor(float(alpha))
+    safetensors_torch.save_file(lora, str(path))
+    return safetensors_torch.load_file(str(path))
+
+def delta(lora, prefix, strength = 1.0):
+    up = lora[prefix + ".lora_up.weight"].float()
+    down = lora[prefix + ".lora_down.weight"].float()
+    alpha = float(lora.get(prefix + ".alpha", down.shape[0]))
+    return strength * alpha / down.shape[0] * (up @ down)
+
+def test_fused_delta_matches_sum_of_loras(tmp_path):
+    stack = [
+        (make_lora(tmp_path / "a.safetensors", rank=4, alpha=2, seed=1), 0.8, 0.5),
+        (make_lora(tmp_path / "b.safetensors", rank=8, alpha=8, seed=2), -0.3, 1.2),
+    ]
+    fused = sage_utils.fuse_lora_stack(stack)
+    assert fused is not None
+
+    for prefix in layers:
+        clip = sage_utils.is_clip_lora_key(prefix)
+        expected = sum(delta(lora, prefix, strength_clip if clip else strength_model) for lora, strength_model, strength_clip in stack)
+        assert fused[prefix + ".lora_down.weight"].shape[0] == 12
+        torch.testing.assert_close(delta(fused, prefix), expected, rtol=1e-4, atol=1e-4)
+
+def test_zero_strength_is_left_out(tmp_path):
+    stack = [
+        (make_lora(tmp_path / "a.safetensors", rank=4, alpha=4, seed=1), 1.0, 0.0),
+        (make_lora(tmp_path / "b.safetensors", rank=8, alpha=4, seed=2), 1.0, 1.0),
+    ]
+    fused = sage_utils.fuse_lora_stack(stack)
+    prefix = "lora_te1_text_model_encoder_layers_0_mlp_fc1"
+    assert fused[prefix + ".lora_down.weight"].shape[0] == 8
+    torch.testing.assert_close(delta(fused, prefix), delta(stack[1][0], prefix), rtol=1e-4, atol=1e-4)
+
+def test_unsupported_lora_is_not_fused(tmp_path):
+    lora = make_lora(tmp_path / "a.safetensors", rank=4, alpha=4, seed=1)
+    lora["lora_unet_down_blocks_0_attn1_to_q.hada_w1_a"] = torch.zeros(4, 4)
+    assert sage_utils.fuse_lora_stack([(lora, 1.0, 1.0), (lora, 1.0, 1.0)]) is None